@@ -16,7 +16,7 @@ a = Analysis(
     pathex=['uploader'],
     binaries=None,
     datas=None,
-    hiddenimports=['HTMLParser'],
+    hiddenimports=['HTMLParser', 'onecodex_uploader.watch', 'watchdog.observers.fsevents'],
     hookspath=[],
     runtime_hooks=[],
     excludes=[],
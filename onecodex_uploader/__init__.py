@@ -3,14 +3,18 @@ from __future__ import print_function
 from base64 import b64decode
 import os
 import platform
+import sqlite3
 import sys
 from pkg_resources import resource_filename
 
 from PySide import QtCore, QtGui
 from raven import Client
 
+from onecodex_uploader.control import ControlPlane
+from onecodex_uploader.dedup import DedupIndex
 from onecodex_uploader.mainwindow_ui import Ui_MainWindow
-from onecodex_uploader.upload import check_version, upload_file, get_apikey, UploadException
+from onecodex_uploader.metrics import profile_file
+from onecodex_uploader.upload import upload_file, UploadException
 from onecodex_uploader.sniff import sniff_file
 from onecodex_uploader.version import __version__
 
@@ -92,7 +96,10 @@ class FileListModel(QtCore.QAbstractListModel):
                 return os.path.basename(self.file_names[index.row()])
             # TODO: allow for more columns to e.g. display extra file info
         elif role == QtCore.Qt.ToolTipRole:
-            return self.file_names[index.row()]
+            info = self.file_info[index.row()]
+            return '{}\n~{:,} reads, ~{:,} bases'.format(self.file_names[index.row()],
+                                                         info['file_est_num_recs'],
+                                                         info['file_est_num_bases'])
         elif role == QtCore.Qt.DecorationRole and index.column() == 0:
             if self.file_info[index.row()]['compression'] == 'none':
                 pixmap = QtGui.QPixmap(resource_path('icons/fa-file.png'))
@@ -103,7 +110,8 @@ class FileListModel(QtCore.QAbstractListModel):
     def add_file(self, filename):
         self.reset()  # TODO: remove this to enable multiple files
 
-        qc_results = sniff_file(filename)
+        with profile_file(filename, 'sniff'):
+            qc_results = sniff_file(filename)
         if qc_results['file_type'] == 'bad':
             QtGui.QMessageBox.critical(self.parent, 'Error!', qc_results['msg'],
                                        QtGui.QMessageBox.Abort)
@@ -113,6 +121,11 @@ class FileListModel(QtCore.QAbstractListModel):
                                        'Amino acid FASTX files not supported',
                                        QtGui.QMessageBox.Abort)
             return
+        elif qc_results.get('qc_warnings'):
+            QtGui.QMessageBox.warning(self.parent, 'Warning!',
+                                      'This file may be low quality:\n' +
+                                      '\n'.join(qc_results['qc_warnings']),
+                                      QtGui.QMessageBox.Ok)
 
         self.beginInsertRows(QtCore.QModelIndex(), len(self.file_names), len(self.file_names))
         self.file_names.append(filename)
@@ -126,9 +139,30 @@ class FileListModel(QtCore.QAbstractListModel):
         self.endRemoveRows()
 
 
+class FutureSignal(QtCore.QObject):
+    """
+    Calls `slot` with a finished `concurrent.futures.Future` on the Qt main
+    thread, so network calls can run on the control plane's threads without
+    blocking the event loop; deletes itself once it has fired
+    """
+    done = QtCore.Signal(object)
+
+    def __init__(self, future, slot, parent=None):
+        super(FutureSignal, self).__init__(parent)
+        self.slot = slot
+        self.done.connect(self.finished)
+        future.add_done_callback(self.done.emit)
+
+    def finished(self, future):
+        try:
+            self.slot(future)
+        finally:
+            self.deleteLater()
+
+
 class OCWorker(QtCore.QThread):
     upload_progress = QtCore.Signal(str, float)
-    upload_finished = QtCore.Signal(str)
+    upload_finished = QtCore.Signal(bool, str)
 
     def __init__(self, filename, apikey):
         QtCore.QThread.__init__(self)
@@ -137,13 +171,27 @@ class OCWorker(QtCore.QThread):
 
     def run(self):
         try:
-            upload_file(self.filename, self.apikey, OC_SERVER, self.upload_progress.emit)
-            self.upload_finished.emit('')
+            dedup_index = DedupIndex()
+        except (sqlite3.Error, OSError):  # e.g. the home directory isn't writable
+            dedup_index = None
+        try:
+            result = upload_file(self.filename, self.apikey, OC_SERVER,
+                                 self.upload_progress.emit, dedup_index=dedup_index)
+            if result['duplicate']:
+                self.upload_finished.emit(True, 'This file was already uploaded (as {}), so it '
+                                                'was not uploaded again.'.format(result['s3_path']))
+            else:
+                self.upload_finished.emit(True, 'File uploaded successfully')
         except UploadException as e:
-            self.upload_finished.emit(str(e))
+            self.upload_finished.emit(False, str(e))
             client.captureMessage(str(e))
         except:
+            self.upload_finished.emit(False, 'Upload has failed. Please contact '
+                                             'help@onecodex.com if you experience further issues')
             client.captureException()
+        finally:
+            if dedup_index is not None:
+                dedup_index.close()
 
 
 class OCUploader(QtGui.QMainWindow):
@@ -190,9 +238,17 @@ class OCUploader(QtGui.QMainWindow):
         # set some globals
         self.lock = QtCore.QMutex()
         self.worker = None
+        self.username = None
+        self.control = ControlPlane(OC_SERVER)
 
         # version check
-        should_quit, error_msg = check_version(__version__, OC_SERVER, 'gui')
+        FutureSignal(self.control.check_version(__version__, 'gui'), self.version_checked, self)
+
+    def version_checked(self, future):
+        try:
+            should_quit, error_msg = future.result()
+        except UploadException as e:
+            should_quit, error_msg = False, str(e)
         if error_msg is not None:
             QtGui.QMessageBox.warning(self, 'Error!', error_msg, QtGui.QMessageBox.Ok)
         if should_quit:
@@ -224,18 +280,28 @@ class OCUploader(QtGui.QMainWindow):
             self.reset()
             return
 
-        apikey = get_apikey(username, password, OC_SERVER)
+        self.username = username
+        FutureSignal(self.control.get_apikey(username, password), self.login_finished, self)
+
+    def login_finished(self, future):
+        error_msg = None
+        try:
+            apikey = future.result()
+        except UploadException as e:  # couldn't reach the server
+            apikey, error_msg = None, str(e)
         self.ui.uploadProgress.setRange(0, 400)
         QtGui.QApplication.instance().processEvents()
 
-        if apikey is None or apikey.strip() == '':
+        if error_msg is not None:
+            QtGui.QMessageBox.critical(self, 'Error!', error_msg, QtGui.QMessageBox.Abort)
+        elif apikey is None or apikey.strip() == '':
             # apikey is None is username/password failed, apikey == '' if user has no apikey
             QtGui.QMessageBox.critical(self, 'Error!', 'Could not authenticate successfully.',
                                        QtGui.QMessageBox.Abort)
         elif len(self.files_model.file_names) == 0:
             QtGui.QMessageBox.critical(self, 'Error!', 'No file selected.', QtGui.QMessageBox.Abort)
         else:
-            client.user_context({'username': username})
+            client.user_context({'username': self.username})
             filename = self.files_model.file_names[0]
             self.worker = OCWorker(filename, apikey)
             self.worker.upload_progress.connect(self.upload_progress)
@@ -265,9 +331,9 @@ class OCUploader(QtGui.QMainWindow):
             QtGui.QApplication.instance().processEvents()
             self.lock.unlock()
 
-    def upload_finished(self, msg):
-        if msg == '':
-            QtGui.QMessageBox.information(self, 'Success!', 'File uploaded successfully')
+    def upload_finished(self, success, msg):
+        if success:
+            QtGui.QMessageBox.information(self, 'Success!', msg)
             self.files_model.reset()
         else:
             QtGui.QMessageBox.critical(self, 'Error!', msg, QtGui.QMessageBox.Abort)
@@ -0,0 +1,152 @@
+"""
+Concurrent access to the One Codex API so that logins, version checks and the
+per-file upload round-trips overlap instead of blocking one after another
+"""
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import sqlite3
+
+import requests
+
+from dedup import account_key, ContentHash, find_duplicate, full_hash, record_upload
+from metrics import export_metrics, incr, profile_file, timer
+from upload import (check_version, confirm_upload, get_apikey, init_upload, transfer_file,
+                    UploadException)
+
+
+class ControlPlane(object):
+    """
+    Runs One Codex API calls on a thread pool with a timeout on every request.
+
+    Each call returns a `concurrent.futures.Future`; the CLI can block on these
+    directly and the GUI hooks them into the Qt event loop with signals.
+    Connection problems and timeouts are raised from the futures as
+    `UploadException`s.
+    """
+    def __init__(self, server_url, timeout=30, max_workers=8):
+        self.server_url = server_url
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _submit(self, func, *args, **kwargs):
+        def call():
+            try:
+                return func(*args, **kwargs)
+            except requests.RequestException:
+                raise UploadException('Could not connect to the One Codex server')
+        return self.executor.submit(call)
+
+    def get_apikey(self, username, password):
+        return self._submit(get_apikey, username, password, self.server_url,
+                            timeout=self.timeout)
+
+    def check_version(self, version, client='cli'):
+        return self._submit(check_version, version, self.server_url, client,
+                            timeout=self.timeout)
+
+    def init_upload(self, apikey):
+        return self._submit(init_upload, apikey, self.server_url, timeout=self.timeout)
+
+    def confirm_upload(self, filename, apikey, upload_params):
+        return self._submit(confirm_upload, filename, apikey, self.server_url, upload_params,
+                            timeout=self.timeout)
+
+    def upload_files(self, filenames, apikey, progress_callback=None, dedup_index=None,
+                     max_transfers=1):
+        """
+        Upload a batch of files. The init_multipart_upload calls for every file
+        are made up front and concurrently, files are sent to S3
+        `max_transfers` at a time, and the completion callbacks for the whole
+        batch are fired together once the transfers are done.
+
+        Returns a dict mapping each filename to a result (as from `upload_file`)
+        or to the exception raised while uploading it.
+        """
+        results = {}
+        fingerprints, content_hashes = {}, {}
+        batch_fingerprints, copies = {}, {}
+        to_upload = []
+        account = account_key(self.server_url, apikey)
+        for filename in filenames:
+            incr('upload.files')
+            if dedup_index is None:
+                to_upload.append(filename)
+                continue
+
+            with timer('upload.fingerprint'):
+                fingerprint, previous = find_duplicate(dedup_index, account, filename)
+            if previous is not None:
+                incr('upload.duplicates')
+                if progress_callback is not None:
+                    progress_callback(filename, 1.0)
+                results[filename] = previous
+            elif fingerprint in batch_fingerprints and \
+                    full_hash(batch_fingerprints[fingerprint]) == full_hash(filename):
+                # the same file is in this batch twice; just upload it once
+                incr('upload.duplicates')
+                copies[filename] = batch_fingerprints[fingerprint]
+            else:
+                batch_fingerprints[fingerprint] = filename
+                fingerprints[filename] = fingerprint
+                to_upload.append(filename)
+
+        inits = dict((filename, self.init_upload(apikey)) for filename in to_upload)
+
+        def transfer(filename):
+            try:
+                with timer('upload.file'), profile_file(filename, 'upload'):
+                    upload_params = inits[filename].result()
+                    if dedup_index is not None:
+                        # hash the whole file alongside the transfer to confirm future matches
+                        content_hashes[filename] = ContentHash(filename)
+                    try:
+                        transfer_file(filename, upload_params, progress_callback)
+                    except:
+                        if filename in content_hashes:
+                            content_hashes[filename].cancel()
+                        raise
+                    return upload_params
+            finally:
+                export_metrics()
+
+        with ThreadPoolExecutor(max_workers=max_transfers) as transfer_pool:
+            transfers = [(filename, transfer_pool.submit(transfer, filename))
+                         for filename in to_upload]
+
+        # every file's exception is kept in its result so one bad file (an S3
+        # error, a file moved mid-upload) doesn't lose the rest of the batch
+        confirms = {}
+        for filename, future in transfers:
+            try:
+                confirms[self.confirm_upload(filename, apikey, future.result())] = filename
+            except Exception as e:
+                results[filename] = e
+
+        for future in as_completed(confirms):
+            filename = confirms[future]
+            try:
+                results[filename] = future.result()
+            except Exception as e:
+                results[filename] = e
+                if filename in content_hashes:
+                    content_hashes[filename].cancel()
+                continue
+            if dedup_index is not None:
+                try:
+                    record_upload(dedup_index, account, fingerprints[filename],
+                                  content_hashes[filename], filename, results[filename])
+                except sqlite3.Error:  # the file is uploaded either way
+                    pass
+
+        export_metrics()
+
+        for filename, original in copies.items():
+            if isinstance(results[original], Exception):
+                results[filename] = results[original]
+            else:
+                results[filename] = dict(results[original], duplicate=True)
+                if progress_callback is not None:
+                    progress_callback(filename, 1.0)
+        return results
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,160 @@
+"""
+A local index of previously uploaded files, keyed by content, so the same
+sequencing file isn't uploaded twice under different names
+"""
+from __future__ import division
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.onecodex_uploader', 'dedup.db')
+
+
+def quick_fingerprint(filename, block_size=65536, n_blocks=16):
+    """
+    A cheap fingerprint of a file: its size plus a hash of `n_blocks` blocks
+    sampled evenly across it (always including the first and last block).
+
+    Two files with different fingerprints are definitely different; a match
+    still has to be confirmed with `full_hash`.
+    """
+    size = os.path.getsize(filename)
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as seq_file:
+        if size <= block_size * n_blocks:
+            digest.update(seq_file.read())
+        else:
+            step = (size - block_size) // (n_blocks - 1)
+            for i in range(n_blocks):
+                seq_file.seek(i * step)
+                digest.update(seq_file.read(block_size))
+    return '{}:{}'.format(size, digest.hexdigest())
+
+
+def full_hash(filename, chunk_size=1048576, stop=None):
+    """
+    Streaming sha256 of the entire file; returns None if `stop` (a
+    `threading.Event`) is set before the whole file has been read
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as seq_file:
+        for chunk in iter(lambda: seq_file.read(chunk_size), b''):
+            if stop is not None and stop.is_set():
+                return None
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentHash(object):
+    """
+    Hashes a whole file on a background thread (e.g. while it uploads);
+    `cancel` stops reading the file so a failed upload isn't held up by it
+    """
+    def __init__(self, filename):
+        self.stop = threading.Event()
+        self.sha256 = None
+        self.thread = threading.Thread(target=self._run, args=(filename,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, filename):
+        try:
+            self.sha256 = full_hash(filename, stop=self.stop)
+        except (IOError, OSError):  # e.g. the file was moved mid-upload
+            pass
+
+    def cancel(self):
+        self.stop.set()
+
+    def result(self):
+        """
+        The file's sha256, or None if hashing was cancelled or failed
+        """
+        self.thread.join()
+        return self.sha256
+
+
+def account_key(server_url, apikey):
+    """
+    Identifies the account (and server) files were uploaded to without
+    storing the API key itself in the index
+    """
+    account = '{}\0{}'.format(server_url.rstrip('/'), apikey)
+    return hashlib.sha256(account.encode('utf-8')).hexdigest()
+
+
+def find_duplicate(dedup_index, account, filename):
+    """
+    Look for an earlier upload of the same contents to `account`; a matching
+    fingerprint only counts once the full hashes match too.
+
+    Returns the file's fingerprint and the earlier upload's result (or None).
+    """
+    fingerprint = quick_fingerprint(filename)
+    matches = dedup_index.lookup(account, fingerprint)
+    if matches:
+        sha256 = full_hash(filename)
+        for previous_sha256, file_id, s3_path in matches:
+            if previous_sha256 == sha256:
+                return fingerprint, {'file_id': file_id, 's3_path': s3_path, 'duplicate': True}
+    return fingerprint, None
+
+
+def record_upload(dedup_index, account, fingerprint, content_hash, filename, result):
+    """
+    Add a finished upload to the index once its `ContentHash` is done
+    """
+    sha256 = content_hash.result()
+    if sha256 is not None:
+        dedup_index.add(account, fingerprint, sha256, result['file_id'], result['s3_path'],
+                        os.path.basename(filename))
+
+
+class DedupIndex(object):
+    """
+    Maps file fingerprints to the results of previous uploads, per account;
+    an upload to one account is never used to skip a file for another.
+    Entries are keyed by full hash too, so different files that happen to
+    share a fingerprint are all kept.
+
+    Backed by sqlite so lookups stay fast with hundreds of thousands of
+    entries; safe to share between upload threads.
+    """
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS content_uploads ('
+                        'account TEXT, fingerprint TEXT, sha256 TEXT, file_id TEXT, '
+                        's3_path TEXT, filename TEXT, uploaded REAL, '
+                        'PRIMARY KEY (account, fingerprint, sha256))')
+        self.db.commit()
+
+    def lookup(self, account, fingerprint):
+        """
+        Returns a list of (sha256, file_id, s3_path) for previous uploads to
+        `account` (from `account_key`) with this fingerprint
+        """
+        with self.lock:
+            return self.db.execute('SELECT sha256, file_id, s3_path FROM content_uploads '
+                                   'WHERE account = ? AND fingerprint = ?',
+                                   (account, fingerprint)).fetchall()
+
+    def add(self, account, fingerprint, sha256, file_id, s3_path, filename):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO content_uploads '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (account, fingerprint, sha256, file_id, s3_path, filename,
+                             time.time()))
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM content_uploads').fetchone()[0]
+
+    def close(self):
+        self.db.close()
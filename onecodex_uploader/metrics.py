@@ -0,0 +1,287 @@
+"""
+Lightweight timers and counters for the sniff and upload hot paths.
+
+Metrics are off by default (set ONE_CODEX_METRICS=1 to turn them on) and cost
+a single attribute check per call when disabled. Collected values can be
+written out as Prometheus text (to ONE_CODEX_METRICS_FILE after every upload
+and at exit) or pushed to a StatsD server over UDP.
+"""
+from __future__ import print_function, division
+
+import atexit
+from contextlib import contextmanager
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+
+class _NullTimer(object):
+    """
+    Shared no-op context manager handed out when metrics are disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+try:
+    _replace = os.replace
+except AttributeError:  # python 2
+    def _replace(src, dst):
+        """
+        os.rename can't overwrite files on Windows, so remove the old one
+        first (not atomic there, but still better than never updating)
+        """
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class _Timer(object):
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.time() - self.start)
+        return False
+
+
+class Metrics(object):
+    """
+    A thread-safe registry of counters, gauges and timers.
+
+    Timers are stored as (count, total seconds, max seconds) so they can be
+    exported as Prometheus summaries without keeping every observation.
+    """
+    def __init__(self, enabled=False, metrics_file=None):
+        self.enabled = enabled
+        self.metrics_file = metrics_file
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.exporters = []
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def incr(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        for exporter in self.exporters:
+            exporter.counter(name, value)
+
+    def gauge(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = value
+        for exporter in self.exporters:
+            exporter.gauge(name, value)
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            count, total, longest = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (count + 1, total + seconds, max(longest, seconds))
+        for exporter in self.exporters:
+            exporter.timing(name, seconds)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+
+    def to_prometheus(self, prefix='onecodex_uploader'):
+        """
+        Render the current metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            timers = sorted(self.timers.items())
+        for name, value in counters:
+            metric = _prometheus_name(prefix, name) + '_total'
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {}'.format(metric, value))
+        for name, value in gauges:
+            metric = _prometheus_name(prefix, name)
+            lines.append('# TYPE {} gauge'.format(metric))
+            lines.append('{} {}'.format(metric, value))
+        for name, (count, total, longest) in timers:
+            metric = _prometheus_name(prefix, name) + '_seconds'
+            lines.append('# TYPE {} summary'.format(metric))
+            lines.append('{}_count {}'.format(metric, count))
+            lines.append('{}_sum {:.6f}'.format(metric, total))
+            lines.append('# TYPE {}_max gauge'.format(metric))
+            lines.append('{}_max {:.6f}'.format(metric, longest))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write_prometheus(self, path, prefix='onecodex_uploader'):
+        """
+        Write the current metrics to `path` (e.g. for node_exporter's textfile
+        collector); the file is replaced atomically so scrapers never see a
+        partial write
+        """
+        text = self.to_prometheus(prefix)
+        with self.write_lock:
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                            suffix='.tmp', dir=os.path.dirname(path) or '.')
+            try:
+                with os.fdopen(fd, 'w') as metrics_file:
+                    metrics_file.write(text)
+                os.chmod(tmp_path, 0o644)  # mkstemp files are only readable by us
+                _replace(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+
+
+def _prometheus_name(prefix, name):
+    return re.sub('[^a-zA-Z0-9_]', '_', '{}_{}'.format(prefix, name))
+
+
+class StatsdExporter(object):
+    """
+    Pushes every counter increment and timing to a StatsD server over UDP.
+
+    Sends are fire-and-forget; network errors are swallowed so metrics can
+    never break an upload.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='onecodex_uploader'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self.sock.sendto(line.encode('utf-8'), self.address)
+        except (socket.error, OSError):
+            pass
+
+    def counter(self, name, value):
+        self._send('{}.{}:{}|c'.format(self.prefix, name, value))
+
+    def gauge(self, name, value):
+        self._send('{}.{}:{}|g'.format(self.prefix, name, value))
+
+    def timing(self, name, seconds):
+        self._send('{}.{}:{:.3f}|ms'.format(self.prefix, name, 1000 * seconds))
+
+    def close(self):
+        self.sock.close()
+
+
+METRICS = Metrics(enabled=os.environ.get('ONE_CODEX_METRICS', '') not in ('', '0'),
+                  metrics_file=os.environ.get('ONE_CODEX_METRICS_FILE'))
+if METRICS.enabled and os.environ.get('ONE_CODEX_STATSD'):
+    # e.g. ONE_CODEX_STATSD=localhost:8125
+    _host, _, _port = os.environ['ONE_CODEX_STATSD'].partition(':')
+    METRICS.exporters.append(StatsdExporter(_host, _port or 8125))
+
+timer = METRICS.timer
+incr = METRICS.incr
+
+
+def export_metrics():
+    """
+    Write the Prometheus text file, if metrics are on and a file was set up;
+    errors are swallowed so metrics can never break an upload
+    """
+    if not METRICS.enabled or not METRICS.metrics_file:
+        return
+    try:
+        METRICS.write_prometheus(METRICS.metrics_file)
+    except (IOError, OSError):
+        pass
+
+
+atexit.register(export_metrics)
+
+_TRACEMALLOC_LOCK = threading.Lock()
+_PROFILING = threading.local()
+
+
+@contextmanager
+def profile_file(filename, stage, output_dir=None):
+    """
+    Optionally run cProfile (and tracemalloc, where available) around one
+    stage of processing a single file. Enabled by setting ONE_CODEX_PROFILE
+    to a directory; the profile is written to `<dir>/<basename>.<stage>.prof`
+    and the peak traced memory is recorded as a `profile.<stage>.peak_bytes`
+    gauge.
+
+    Profiles can't be nested: a stage that starts while another is being
+    profiled on the same thread (or, on python 3.12+, any thread) runs
+    unprofiled and is included in the outer profile instead.
+    """
+    output_dir = output_dir or os.environ.get('ONE_CODEX_PROFILE')
+    if getattr(_PROFILING, 'active', False):
+        output_dir = None  # a new profiler would replace the running one's hook
+    if output_dir and not os.path.isdir(output_dir):
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            output_dir = None
+    if not output_dir:
+        yield
+        return
+
+    import cProfile
+    try:
+        import tracemalloc
+    except ImportError:  # python 2
+        tracemalloc = None
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # python 3.12+ allows one profiler per process
+        yield
+        return
+    _PROFILING.active = True
+
+    # tracemalloc is process-wide, so when several files are profiled at once
+    # (e.g. concurrent uploads) only the first one records peak memory
+    with _TRACEMALLOC_LOCK:
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc = None
+        elif tracemalloc is not None:
+            tracemalloc.start()
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _PROFILING.active = False
+        prof_name = '{}.{}.prof'.format(os.path.basename(filename), stage)
+        try:
+            profiler.dump_stats(os.path.join(output_dir, prof_name))
+        except (IOError, OSError):
+            pass  # don't hide whatever happened while profiling
+        if tracemalloc is not None:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            METRICS.gauge('profile.{}.peak_bytes'.format(stage), peak)
@@ -0,0 +1,117 @@
+"""
+Quality control screening for the reads sampled from a FASTQ
+"""
+from __future__ import division
+
+from array import array
+
+# the first 13bp of common Illumina adapters; reads that run off the end of a
+# short insert will contain these
+ADAPTERS = {
+    'illumina_universal': 'AGATCGGAAGAGC',
+    'illumina_small_rna': 'TGGAATTCTCGG',
+    'nextera': 'CTGTCTCTTATA',
+}
+
+KMER_SIZE = 8
+BASE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+
+def profile_fastq(seqs, quals, qual_offset=33, max_kmers=5):
+    """
+    Given the sequences and quality strings of the sampled reads, return
+    per-cycle quality/N statistics, adapter and overrepresented k-mer hits,
+    and a list of warnings for runs that look like junk.
+    """
+    status = {}
+    # strip the carriage returns left over from CRLF files
+    seqs = [seq.rstrip('\r') for seq in seqs]
+    quals = [qual.rstrip('\r') for qual in quals]
+    n_reads = len(seqs)
+    if n_reads == 0:
+        return status
+
+    # per-cycle quality and N counts; reads are grouped by length so each
+    # cycle's qualities can be summed a column at a time (malformed records
+    # with a quality line that doesn't match the sequence are left out)
+    records = [(seq, qual) for seq, qual in zip(seqs, quals) if len(seq) == len(qual)]
+    max_len = max([len(seq) for seq, _ in records] or [0])
+    qual_sums = array('l', [0]) * max_len
+    n_counts = array('l', [0]) * max_len
+    depth = array('l', [0]) * max_len
+    by_length = {}
+    for seq, qual in records:
+        by_length.setdefault(len(qual), []).append(qual)
+        pos = seq.find('N')
+        while pos != -1:
+            n_counts[pos] += 1
+            pos = seq.find('N', pos + 1)
+    for group in by_length.values():
+        for i, column in enumerate(zip(*group)):
+            qual_sums[i] += sum(map(ord, column))
+            depth[i] += len(group)
+    cycles = [i for i in range(max_len) if depth[i] > 0]
+    status['qc_cycle_mean_qual'] = [round(qual_sums[i] / depth[i] - qual_offset, 1)
+                                    for i in cycles]
+    status['qc_cycle_n_rate'] = [round(n_counts[i] / depth[i], 4) for i in cycles]
+
+    # adapter read-through and low complexity (mostly one base, e.g. poly-G) reads
+    status['qc_adapter_rate'] = dict(
+        (name, round(sum(1 for s in seqs if adapter in s) / n_reads, 4))
+        for name, adapter in ADAPTERS.items())
+    status['qc_low_complexity_rate'] = round(
+        sum(1 for s in seqs if max(s.count(b) for b in 'ACGT') >= 0.8 * len(s)) / n_reads, 4)
+
+    status['qc_overrepresented_kmers'] = overrepresented_kmers(seqs, max_kmers=max_kmers)
+
+    warnings = []
+    if sum(depth) > 0 and sum(qual_sums) / sum(depth) - qual_offset < 20:
+        warnings.append('Average base quality is below Q20')
+    if sum(n_counts) / max(sum(depth), 1) > 0.05:
+        warnings.append('More than 5% of bases are N')
+    for name, rate in status['qc_adapter_rate'].items():
+        if rate > 0.1:
+            warnings.append('More than 10% of reads contain {} adapter'.format(name))
+    if status['qc_low_complexity_rate'] > 0.1:
+        warnings.append('More than 10% of reads are low complexity')
+    status['qc_warnings'] = warnings
+
+    return status
+
+
+def overrepresented_kmers(seqs, k=KMER_SIZE, max_kmers=5, min_fraction=0.01, min_count=10):
+    """
+    Count k-mers with a fixed-size array indexed by their 2-bit encoding
+    (k-mers containing N or other ambiguous bases are skipped) and return the
+    most common ones that make up more than `min_fraction` of all k-mers (and
+    were seen at least `min_count` times).
+    """
+    mask = (1 << (2 * k)) - 1
+    counts = array('l', [0]) * (1 << (2 * k))
+    total = 0
+    for seq in seqs:
+        kmer, valid = 0, 0
+        for base in seq:
+            code = BASE_CODES.get(base)
+            if code is None:
+                valid = 0
+                continue
+            kmer = ((kmer << 2) | code) & mask
+            valid += 1
+            if valid >= k:
+                counts[kmer] += 1
+                total += 1
+    if total == 0:
+        return []
+
+    threshold = max(min_fraction * total, min_count - 1)
+    hits = sorted(((c, i) for i, c in enumerate(counts) if c > threshold), reverse=True)
+    return [(decode_kmer(i, k), round(c / total, 4)) for c, i in hits[:max_kmers]]
+
+
+def decode_kmer(code, k=KMER_SIZE):
+    bases = []
+    for _ in range(k):
+        bases.append('ACGT'[code & 3])
+        code >>= 2
+    return ''.join(reversed(bases))
@@ -7,7 +7,13 @@ from __future__ import print_function, division
 import gzip
 import os
 import re
+import struct
+import zlib
 from collections import Counter
+from itertools import chain
+
+from metrics import timer
+from qc import profile_fastq
 
 COMMON_NA = set('ACGNTUX')
 IUPAC_NA = set('ABCDGHIKMNRSTUVWXY')
@@ -25,11 +31,11 @@ def sniff_file(filename, compress=None):
         return {'file_type': 'bad', 'msg': 'File is too small'}
 
     if compress is None:
-        with open(filename, 'r') as seq_file:
+        with timer('sniff.read'), open(filename, 'r') as seq_file:
             start = seq_file.read(1)
             data = seq_file.read(1000000)
     elif compress == 'gzip':
-        with gzip.open(filename, 'r') as seq_file:
+        with timer('sniff.decompress'), gzip.open(filename, 'r') as seq_file:
             start = seq_file.read(1)
             data = seq_file.read(1000000)
 
@@ -44,29 +50,94 @@ def sniff_file(filename, compress=None):
         status['compression'] = 'gzip'
     else:
         status['compression'] = 'none'
+
+    if status['file_type'] != 'bad':
+        with timer('sniff.estimate'):
+            if len(start) + len(data) < 1000001:
+                # we read the entire file so we know exactly how big it is
+                status['file_est_size'] = len(start) + len(data)
+            elif compress == 'gzip':
+                status['gzip_est_ratio'] = sniff_gzip_ratio(filename)
+                status['file_est_size'] = int(os.path.getsize(filename) *
+                                              status['gzip_est_ratio'])
+            else:
+                status['file_est_size'] = os.path.getsize(filename)
+            status.update(estimate_totals(status))
     return status
 
 
+def sniff_gzip_ratio(filename, sample_size=1000000):
+    """
+    Estimate how many times larger a gzipped file is once decompressed.
+
+    The ISIZE trailer (the uncompressed size of the last gzip member, mod 2^32)
+    is exact for single-member files under 4Gb, so we use it when it agrees
+    with the ratio seen decompressing the first `sample_size` bytes; otherwise
+    (e.g. bgzipped or very large files) we fall back to the sampled ratio.
+    """
+    compressed, uncompressed = 0, 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(filename, 'rb') as gz_file:
+        while uncompressed < sample_size:
+            chunk = gz_file.read(65536)
+            if not chunk:
+                break
+            while chunk:
+                uncompressed += len(decompressor.decompress(chunk))
+                if decompressor.unused_data:
+                    # we hit the start of another gzip member
+                    compressed += len(chunk) - len(decompressor.unused_data)
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    compressed += len(chunk)
+                    chunk = None
+        gz_file.seek(-4, os.SEEK_END)
+        isize = struct.unpack('<I', gz_file.read(4))[0]
+
+    file_size = os.path.getsize(filename)
+    sample_ratio = uncompressed / compressed if compressed > 0 else 1.
+    isize_ratio = isize / file_size
+    if 0.5 * sample_ratio < isize_ratio < 2 * sample_ratio:
+        return isize_ratio
+    return sample_ratio
+
+
+def estimate_totals(status):
+    """
+    Extrapolate the number of records and bases in the whole file from the
+    sampled record size and the (estimated) uncompressed size of the file.
+    """
+    num_recs = status['file_est_size'] / status['rec_est_bytes']
+    return {
+        'file_est_num_recs': int(round(num_recs)),
+        'file_est_num_bases': int(round(num_recs * status['seq_est_avg_len'])),
+    }
+
+
 def sniff(start, data):
     """
     Given the first byte (start) and an unspecified (maybe not all) amount of
     a FASTA or FASTQ, return summary statistics.
     """
     # scan through the file and get ids/seq_counts (and quality info)
-    if start == '>':
-        seq_count, ids, status = read_fasta(data)
-    elif start == '@':
-        seq_count, ids, status = read_fastq(data)
-    else:
-        return {'file_type': 'bad', 'msg': 'File is not a valid FASTA or FASTQ file'}
+    with timer('sniff.parse'):
+        if start == '>':
+            seq_count, ids, status = read_fasta(data)
+        elif start == '@':
+            seq_count, ids, status = read_fastq(data)
+        else:
+            return {'file_type': 'bad', 'msg': 'File is not a valid FASTA or FASTQ file'}
 
     num_recs = len(ids)
     if num_recs < 1:
         return {'file_type': 'bad', 'msg': 'No records found in file'}
     elif sum(seq_count.values()) < 1:
         return {'file_type': 'bad', 'msg': 'No sequence data found in file'}
-    status.update(sniff_bases(seq_count, num_recs))
-    status.update(sniff_ids(ids))
+    with timer('sniff.stats'):
+        status['rec_est_bytes'] = (len(start) + len(data)) / num_recs
+        status.update(sniff_bases(seq_count, num_recs))
+        status.update(sniff_ids(ids))
 
     return status
 
@@ -146,9 +217,10 @@ def sniff_ids(ids):
     singled = [i.replace('2', '1') for i in ids]
     status['interleaved'] = all(singled[2 * i] == singled[2 * i + 1] for
                                 i in range(len(singled) // 2)) and len(ids) > 1
+
+    status['id_est_len'] = sum(len(i) for i in ids) / len(ids)
     return status
 
-    # TODO: return id_est_len to help estimate # of sequences in file
     # TODO: determine id type? (sequencer, assembler, database ...)
 
     # # https://en.wikipedia.org/wiki/FASTA_format#Sequence_identifiers
@@ -202,18 +274,72 @@ def sniff_ids(ids):
 
 
 def read_fasta(data):
-    fasta_re = re.compile(r"""
-        (?P<id>[^\n]+)\n  # the identifier line
-        (?P<seq>[^>]+)  # the sequence
-        (?:\n>|\Z)  # start of the next record
-    """, re.VERBOSE)
-    ids = []
+    """
+    Scan through FASTA data a line at a time, keeping running per-record
+    lengths and base counts so memory use doesn't depend on how long any one
+    record is. `data` can be a string or any iterable of lines (e.g. an open
+    file); the leading '>' of the first record is optional.
+    """
+    lines = iter_lines(data) if hasattr(data, 'find') else data
+    ids, lengths = [], []
+    widths = Counter()  # widths of every line but the last in each record
     seq_count = Counter()
-    for match in fasta_re.finditer(data):
-        rec = match.groupdict()
-        ids.append(rec['id'])
-        seq_count.update(Counter(rec['seq'].rstrip()))
-    return seq_count, ids, {'file_type': 'fasta'}
+
+    rec_id, rec_len, rec_lines, prev_width = None, 0, 0, None
+    for line in chain(lines, ['>']):
+        line = line.rstrip('\r\n')
+        if rec_id is None or line.startswith('>'):
+            if rec_id and rec_len > 0:
+                ids.append(rec_id)
+                lengths.append(rec_len)
+                seq_count['\n'] += rec_lines - 1
+            rec_id = line[1:] if line.startswith('>') else line
+            rec_len, rec_lines, prev_width = 0, 0, None
+        elif line != '':
+            if prev_width is not None:
+                widths[prev_width] += 1
+            seq_count.update(line)
+            rec_len += len(line)
+            rec_lines += 1
+            prev_width = len(line)
+
+    status = {'file_type': 'fasta'}
+    if lengths:
+        status.update(sniff_lengths(lengths))
+    status['seq_line_width'] = widths.most_common(1)[0][0] if widths else None
+    status['seq_line_width_consistent'] = len(widths) <= 1
+    return seq_count, ids, status
+
+
+def iter_lines(data):
+    """
+    Lazily yield the lines of a string, so only one line is copied at a time
+    """
+    start = 0
+    while start < len(data):
+        end = data.find('\n', start)
+        if end == -1:
+            end = len(data)
+        yield data[start:end]
+        start = end + 1
+
+
+def sniff_lengths(lengths):
+    """
+    Summarize the distribution of record lengths (e.g. contigs in an assembly)
+    """
+    lengths = sorted(lengths, reverse=True)
+    half_total, running = sum(lengths) / 2, 0
+    for n50 in lengths:
+        running += n50
+        if running >= half_total:
+            break
+    return {
+        'seq_n50': n50,
+        'seq_min_len': lengths[-1],
+        'seq_max_len': lengths[0],
+        'seq_median_len': lengths[len(lengths) // 2],
+    }
 
 
 def read_fastq(data):
@@ -222,11 +348,12 @@ def read_fastq(data):
         (?P<seq>[^\n]+)\n
         \+(?P<id2>[^\n]*)\n
         (?P<qual>[^\n]+)
-        (?:\n@|\Z)
+        (?:\n@|\n?\Z)
     """, re.DOTALL + re.VERBOSE)
     status = {'file_type': 'fastq'}
     qual_set = set()
     ids = []
+    seqs, quals = [], []
     seq_count = Counter()
     for match in fastq_re.finditer(data):
         rec = match.groupdict()
@@ -237,6 +364,8 @@ def read_fastq(data):
             else:
                 status['qual_ids'] = 'nonmatch'
         ids.append(rec['id'])
+        seqs.append(rec['seq'])
+        quals.append(rec['qual'])
         qual_set.update(rec['qual'])
         seq_count.update(Counter(rec['seq']))
 
@@ -260,6 +389,11 @@ def read_fastq(data):
     else:
         status['qual_type'] = 'bad'
 
+    if status['qual_type'] != 'bad':
+        qual_offset = 33 if status['qual_type'] in ('sanger', 'illumina 1.8') else 64
+        with timer('sniff.qc'):
+            status.update(profile_fastq(seqs, quals, qual_offset))
+
     return seq_count, ids, status
 
 
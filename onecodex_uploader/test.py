@@ -1,6 +1,19 @@
-from sniff import sniff_file
-from upload import check_version, get_apikey
+import gzip
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+from control import ControlPlane
+from dedup import (account_key, ContentHash, DedupIndex, find_duplicate, full_hash,
+                   quick_fingerprint, record_upload)
+from metrics import Metrics, profile_file
+from qc import decode_kmer, overrepresented_kmers, profile_fastq
+from sniff import read_fasta, sniff_file, sniff_gzip_ratio
+from upload import check_version, get_apikey, UploadException
 from version import __version__
+from watch import default_ledger_path, FolderWatcher, is_sequence_file, Ledger
 
 SERVER = 'https://app.onecodex.com/'
 
@@ -23,6 +36,13 @@ def test_sniffer():
     assert resp['seq_est_avg_len'] == 74.0
     assert resp['seq_est_gc'] == 0.5
 
+    assert resp['file_est_size'] == 82
+    assert resp['file_est_num_recs'] == 1
+    assert resp['file_est_num_bases'] == 74
+    assert resp['id_est_len'] == 5.0
+    assert resp['seq_n50'] == 74
+    assert resp['seq_line_width'] is None
+
     assert not resp['interleaved']
 
     resp = sniff_file('onecodex_uploader/test_data/test.fq')
@@ -42,9 +62,290 @@ def test_sniffer():
 
     assert resp['seq_est_avg_len'] == 31.0
 
+    assert resp['file_est_num_recs'] == 10
+    assert resp['file_est_num_bases'] == 310
+
+    assert len(resp['qc_cycle_mean_qual']) == 31
+    assert resp['qc_cycle_n_rate'][-1] > 0
+    assert resp['qc_warnings'] == []
+
     assert not resp['interleaved']
 
 
+def test_read_fasta():
+    data = '>contig1\n' + 'ACGTACGTAC\n' * 100 + 'ACG\n>contig2\nACGTACGTAC\nAC\n>contig3\nAAAA\n'
+    for lines in (data, iter(data.splitlines(True))):
+        seq_count, ids, status = read_fasta(lines)
+        assert ids == ['contig1', 'contig2', 'contig3']
+        assert seq_count['\n'] == 101
+        assert sum(seq_count.values()) - seq_count['\n'] == 1003 + 12 + 4
+        assert status['seq_n50'] == 1003
+        assert status['seq_min_len'] == 4
+        assert status['seq_max_len'] == 1003
+        assert status['seq_line_width'] == 10
+        assert status['seq_line_width_consistent']
+
+    _, _, status = read_fasta('>contig1\nACGTACGTAC\nACG\n>contig2\nACGTACGT\nAC\n')
+    assert not status['seq_line_width_consistent']
+
+    try:
+        import tracemalloc
+    except ImportError:  # python 2
+        return
+    # memory use shouldn't scale with the amount of data being sniffed
+    data = '>contig\n' + '\n'.join(['ACGTACGTNN' * 6] * 16000) + '\n'
+    tracemalloc.start()
+    read_fasta(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < len(data) // 4
+
+
+def test_sniff_gzip_ratio():
+    gz_file = os.path.join(tempfile.mkdtemp(), 'test.fq.gz')
+    with open('onecodex_uploader/test_data/test.fq', 'rb') as f:
+        data = f.read() * 1000
+    with gzip.open(gz_file, 'wb') as f:
+        f.write(data)
+    ratio = sniff_gzip_ratio(gz_file)
+    assert abs(ratio * os.path.getsize(gz_file) - len(data)) < 1
+
+
+def test_qc_profile():
+    assert decode_kmer(0) == 'AAAAAAAA'
+    assert decode_kmer(27, k=4) == 'ACGT'
+    assert overrepresented_kmers(['ACGT' * 10] * 5, k=4) == \
+        [('ACGT', 0.2703), ('TACG', 0.2432), ('GTAC', 0.2432), ('CGTA', 0.2432)]
+
+    seqs = ['ACGTACGTAGATCGGAAGAGCACACG',
+            'GGGGGGGGGGGGGGGGGGGGGGGGGG',
+            'NNNNACGTACGTACGTACGTACGTAC']
+    quals = ['#' * 26, '#' * 26, 'I' * 26]
+    resp = profile_fastq(seqs, quals)
+    assert resp['qc_cycle_mean_qual'][0] == 14.7
+    assert resp['qc_cycle_n_rate'][0] == 0.3333
+    assert resp['qc_cycle_n_rate'][4] == 0.0
+    assert resp['qc_adapter_rate']['illumina_universal'] == 0.3333
+    assert resp['qc_low_complexity_rate'] == 0.3333
+    assert 'Average base quality is below Q20' in resp['qc_warnings']
+
+    # CRLF line endings and quality lines that don't match their sequence
+    resp = profile_fastq(['ACGT\r', 'ACGT\r', 'AC\r'], ['IIII\r', 'IIII\r', 'IIIIIIII\r'])
+    assert resp['qc_cycle_mean_qual'] == [40.0, 40.0, 40.0, 40.0]
+    assert resp['qc_cycle_n_rate'] == [0.0, 0.0, 0.0, 0.0]
+
+
+def test_metrics():
+    metrics = Metrics(enabled=False)
+    with metrics.timer('sniff.parse'):
+        pass
+    metrics.incr('upload.files')
+    assert metrics.to_prometheus() == ''
+
+    metrics.enabled = True
+    with metrics.timer('sniff.parse'):
+        pass
+    metrics.incr('upload.files', 2)
+    metrics.gauge('profile.sniff.peak_bytes', 1024)
+    text = metrics.to_prometheus()
+    assert 'onecodex_uploader_upload_files_total 2' in text
+    assert 'onecodex_uploader_profile_sniff_peak_bytes 1024' in text
+    assert 'onecodex_uploader_sniff_parse_seconds_count 1' in text
+
+    metrics_path = os.path.join(tempfile.mkdtemp(), 'uploader.prom')
+    metrics.write_prometheus(metrics_path)
+    with open(metrics_path) as f:
+        assert f.read() == text
+    metrics.incr('upload.files')
+    metrics.write_prometheus(metrics_path)  # replaces the earlier file
+    with open(metrics_path) as f:
+        assert 'onecodex_uploader_upload_files_total 3' in f.read()
+    assert os.listdir(os.path.dirname(metrics_path)) == ['uploader.prom']
+
+    # a missing profile directory is created rather than breaking the upload
+    profile_dir = os.path.join(tempfile.mkdtemp(), 'profiles')
+    with profile_file('test.fq', 'sniff', profile_dir):
+        pass
+    assert os.path.exists(os.path.join(profile_dir, 'test.fq.sniff.prof'))
+
+    # a nested profile would knock out the outer one, so only the outer one runs
+    with profile_file('a.fq', 'upload', profile_dir):
+        with profile_file('b.fq', 'sniff', profile_dir):
+            sniff_file('onecodex_uploader/test_data/test.fq')
+    assert not os.path.exists(os.path.join(profile_dir, 'b.fq.sniff.prof'))
+    stats = pstats.Stats(os.path.join(profile_dir, 'a.fq.upload.prof'))
+    assert any(func[2] == 'sniff_file' for func in stats.stats)
+
+
+def test_watch_ledger():
+    assert is_sequence_file('/run/sample_R1.fastq.gz')
+    assert is_sequence_file('/run/contigs.FA')
+    assert not is_sequence_file('/run/.sample_R1.fastq')
+    assert not is_sequence_file('/run/RTAComplete.txt')
+
+    ledger_path = os.path.join(tempfile.mkdtemp(), 'ledger.db')
+    ledger = Ledger(ledger_path)
+    ledger.record('/run/a.fq', 100, 1.0, 'uploaded')
+    ledger.record('/run/b.fq', 100, 1.0, 'failed', 'Upload has failed')
+    ledger.close()
+
+    ledger = Ledger(ledger_path)
+    assert ledger.seen('/run/a.fq', 100, 1.0)
+    assert not ledger.seen('/run/a.fq', 200, 2.0)  # file was rewritten
+    assert not ledger.seen('/run/b.fq', 100, 1.0)  # failures are retried
+    assert not ledger.seen('/run/c.fq', 100, 1.0)
+    ledger.close()
+
+    # ledgers live outside the (possibly read-only) watched folder, one per folder
+    assert not default_ledger_path('/data/run1').startswith('/data/run1')
+    assert default_ledger_path('/data/run1') == default_ledger_path('/data/run1/')
+    assert default_ledger_path('/data/run1') != default_ledger_path('/archive/run1')
+
+
+def test_dedup_index():
+    fq_fingerprint = quick_fingerprint('onecodex_uploader/test_data/test.fq')
+    assert fq_fingerprint == quick_fingerprint('onecodex_uploader/test_data/test.fq')
+    assert fq_fingerprint != quick_fingerprint('onecodex_uploader/test_data/test.fa')
+    assert fq_fingerprint.startswith('{}:'.format(os.path.getsize(
+        'onecodex_uploader/test_data/test.fq')))
+
+    # sampled blocks are used once files are larger than the sample
+    big_file = os.path.join(tempfile.mkdtemp(), 'big.fq')
+    with open(big_file, 'wb') as f:
+        f.write(b'ACGT' * 1000000)
+    assert quick_fingerprint(big_file, block_size=1024, n_blocks=4) != \
+        quick_fingerprint(big_file, block_size=1024, n_blocks=8)
+
+    account_a = account_key(SERVER, 'apikey_a')
+    account_b = account_key(SERVER, 'apikey_b')
+    assert account_a != account_b
+    assert account_a != account_key('https://other.onecodex.com/', 'apikey_a')
+    assert account_a == account_key(SERVER.rstrip('/'), 'apikey_a')
+
+    index = DedupIndex(os.path.join(tempfile.mkdtemp(), 'dedup.db'))
+    assert index.lookup(account_a, fq_fingerprint) == []
+    sha256 = full_hash('onecodex_uploader/test_data/test.fq')
+    index.add(account_a, fq_fingerprint, sha256, 'abc123', 's3://bucket/abc123', 'test.fq')
+    assert index.lookup(account_a, fq_fingerprint) == [(sha256, 'abc123', 's3://bucket/abc123')]
+    assert index.lookup(account_b, fq_fingerprint) == []  # never skip across accounts
+    assert len(index) == 1
+
+    # a different file with the same fingerprint doesn't replace the first one
+    index.add(account_a, fq_fingerprint, 'other', 'ghi789', 's3://bucket/ghi789', 'other.fq')
+    assert len(index.lookup(account_a, fq_fingerprint)) == 2
+
+    assert find_duplicate(index, account_a, 'onecodex_uploader/test_data/test.fq') == \
+        (fq_fingerprint, {'file_id': 'abc123', 's3_path': 's3://bucket/abc123',
+                          'duplicate': True})
+    assert find_duplicate(index, account_b, 'onecodex_uploader/test_data/test.fq') == \
+        (fq_fingerprint, None)
+
+    content_hash = ContentHash(big_file)
+    content_hash.cancel()
+    assert content_hash.result() in (None, full_hash(big_file))
+    content_hash = ContentHash(big_file)
+    assert content_hash.result() == full_hash(big_file)
+    record_upload(index, account_b, fq_fingerprint, content_hash, big_file,
+                  {'file_id': 'def456', 's3_path': 's3://bucket/def456'})
+    assert len(index) == 3
+    index.close()
+
+
+def test_watch_completion_marker():
+    run_folder = tempfile.mkdtemp()
+    open(os.path.join(run_folder, 'RTAComplete.txt'), 'w').close()
+    with open('onecodex_uploader/test_data/test.fq') as f:
+        fastq = f.read()
+    with open(os.path.join(run_folder, 'sample.fq'), 'w') as f:
+        f.write(fastq)
+
+    batches = []
+    watcher = FolderWatcher(run_folder, 'apikey', SERVER, settle_time=3600, log=lambda m: None,
+                            ledger_path=os.path.join(tempfile.mkdtemp(), 'ledger.db'))
+    watcher.process = batches.append
+    watcher.scan()
+    watcher.check_pending()  # first sighting; could still be being written
+    assert batches == []
+    watcher.check_pending()  # unchanged and the run is marked complete
+    watcher.executor.shutdown(wait=True)
+    assert [path for path, _, _ in batches[0]] == [os.path.join(run_folder, 'sample.fq')]
+    watcher.control.shutdown()
+    watcher.ledger.close()
+
+
+def test_watch_unreadable_file():
+    run_folder = tempfile.mkdtemp()
+    truncated = os.path.join(run_folder, 'sample.fq.gz')
+    with open('onecodex_uploader/test_data/test.fq', 'rb') as f:
+        data = f.read() * 1000
+    with gzip.open(truncated, 'wb') as f:
+        f.write(data)
+    with open(truncated, 'rb') as f:
+        data = f.read()
+    with open(truncated, 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    watcher = FolderWatcher(run_folder, 'apikey', SERVER, log=lambda m: None,
+                            ledger_path=os.path.join(tempfile.mkdtemp(), 'ledger.db'))
+    stat = os.stat(truncated)
+    assert watcher.check_file(truncated, stat.st_size, stat.st_mtime) is None
+    assert watcher.ledger.seen(truncated, stat.st_size, stat.st_mtime)
+    watcher.control.shutdown()
+    watcher.ledger.close()
+
+
+def test_watch_batch_failure():
+    run_folder = tempfile.mkdtemp()
+    seq_file = os.path.join(run_folder, 'sample.fq')
+    with open(seq_file, 'w') as f:
+        f.write('@read\nACGT\n+\nIIII\n')
+
+    def upload_files(*args, **kwargs):
+        raise RuntimeError('unexpected')
+
+    watcher = FolderWatcher(run_folder, 'apikey', SERVER, log=lambda m: None,
+                            ledger_path=os.path.join(tempfile.mkdtemp(), 'ledger.db'))
+    watcher.control.upload_files = upload_files
+    stat = os.stat(seq_file)
+    watcher.in_progress.add(seq_file)
+    watcher.process([(seq_file, stat.st_size, stat.st_mtime)])
+    row = watcher.ledger.db.execute('SELECT status FROM files WHERE path = ?',
+                                    (seq_file,)).fetchone()
+    assert row == ('failed',)
+    assert not watcher.ledger.seen(seq_file, stat.st_size, stat.st_mtime)  # will be retried
+    assert seq_file not in watcher.in_progress
+    watcher.control.shutdown()
+    watcher.ledger.close()
+
+
+def test_watch_retries_with_observer():
+    run_folder = tempfile.mkdtemp()
+    with open('onecodex_uploader/test_data/test.fq') as f:
+        data = f.read()
+    with open(os.path.join(run_folder, 'sample.fq'), 'w') as f:
+        f.write(data)
+
+    attempts = []
+
+    def upload_files(filenames, *args, **kwargs):
+        attempts.append(filenames)
+        return dict((filename, UploadException('Upload has failed'))
+                    for filename in filenames)
+
+    # even when the observer is running, failed files are picked up on a rescan
+    watcher = FolderWatcher(run_folder, 'apikey', SERVER, settle_time=0, poll_interval=0.05,
+                            rescan_interval=0.2, log=lambda m: None,
+                            ledger_path=os.path.join(tempfile.mkdtemp(), 'ledger.db'))
+    watcher.start_observer = lambda: True
+    watcher.control.upload_files = upload_files
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    time.sleep(1)
+    watcher.stop()
+    thread.join()
+    assert len(attempts) > 1
+
+
 def test_check_version():
     should_upgrade, msg = check_version(__version__, SERVER, 'gui')
 
@@ -55,3 +356,14 @@ def test_check_version():
 def test_login():
     resp = get_apikey('test', 'test', SERVER)
     assert resp is None  # should not be able to log in with this
+
+
+def test_control_plane():
+    control = ControlPlane(SERVER)
+    version_check = control.check_version(__version__, 'gui')
+    login = control.get_apikey('test', 'test')
+
+    should_upgrade, msg = version_check.result()
+    assert not should_upgrade
+    assert login.result() is None
+    control.shutdown()
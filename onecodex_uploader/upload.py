@@ -5,12 +5,18 @@ into the onecodex python library at some point for use across CLI and GUI client
 import os
 from math import floor
 import re
+import sqlite3
+import threading
+import time
 
 import requests
 import boto3
-from boto3.s3.transfer import S3Transfer
+from boto3.s3.transfer import S3Transfer, TransferConfig
 from boto3.exceptions import S3UploadFailedError
 
+from dedup import account_key, ContentHash, find_duplicate, record_upload
+from metrics import export_metrics, METRICS, incr, profile_file, timer
+
 
 class UploadException(Exception):
     """
@@ -19,16 +25,44 @@ class UploadException(Exception):
     pass
 
 
-def get_apikey(username, password, server_url):
+class PartTimer(object):
+    """
+    Transfer callback that records S3 throughput metrics, optionally chaining
+    to another callback.
+
+    Parts are sent concurrently, so a "part" here is every `part_size` bytes
+    acknowledged by boto rather than one specific S3 part.
+    """
+    def __init__(self, part_size, callback=None):
+        self.part_size = part_size
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_part = time.time()
+
+    def __call__(self, bytes_seen):
+        incr('upload.s3_bytes', bytes_seen)
+        with self.lock:
+            self.pending += bytes_seen
+            if self.pending >= self.part_size:
+                self.pending -= self.part_size
+                now = time.time()
+                METRICS.observe('upload.s3_part', now - self.last_part)
+                self.last_part = now
+        if self.callback is not None:
+            self.callback(bytes_seen)
+
+
+def get_apikey(username, password, server_url, timeout=None):
     """
     Retrieves an API key from the One Codex webpage given the username and password
     """
-    with requests.Session() as session:
-        text = session.get(server_url + 'login').text
+    with timer('upload.get_apikey'), requests.Session() as session:
+        text = session.get(server_url + 'login', timeout=timeout).text
         csrf = re.search('type="hidden" value="([^"]+)"', text).group(1)
         login_data = {'email': username, 'password': password,
                       'csrf_token': csrf, 'next': '/api/get_token'}
-        page = session.post(server_url + 'login', data=login_data)
+        page = session.post(server_url + 'login', data=login_data, timeout=timeout)
         try:
             key = page.json()['key']
         except (ValueError, KeyError):  # ValueError includes simplejson.decoder.JSONDecodeError
@@ -36,7 +70,7 @@ def get_apikey(username, password, server_url):
     return key
 
 
-def check_version(version, server_url, client='cli'):
+def check_version(version, server_url, client='cli', timeout=None):
     """
     Check if the current version of the client software is supported by the One Codex
     backend. Returns a tuple with two values:
@@ -52,13 +86,15 @@ def check_version(version, server_url, client='cli'):
         """
         return tuple(client_version.split('.')) < tuple(server_version.split('.'))
 
-    if client == 'cli':
-        data = requests.post(server_url + 'api/v0/check_for_cli_update', data={'version': version})
-    elif client == 'gui':
-        data = requests.post(server_url + 'api/v0/check_upload_app_version',
-                             data={'version': version})
-    else:
-        raise Exception('Not a valid client descriptor')
+    with timer('upload.check_version'):
+        if client == 'cli':
+            data = requests.post(server_url + 'api/v0/check_for_cli_update',
+                                 data={'version': version}, timeout=timeout)
+        elif client == 'gui':
+            data = requests.post(server_url + 'api/v0/check_upload_app_version',
+                                 data={'version': version}, timeout=timeout)
+        else:
+            raise Exception('Not a valid client descriptor')
 
     if data.status_code != 200:
         return False, 'Error connecting to server'
@@ -86,22 +122,87 @@ def check_version(version, server_url, client='cli'):
     return False, None
 
 
-def upload_file(filename, apikey, server_url, progress_callback=None, n_callbacks=400):
+def upload_file(filename, apikey, server_url, progress_callback=None, n_callbacks=400,
+                dedup_index=None):
     """
     Uploads a file to the One Codex server (and handles files >5Gb)
 
     Takes an optional callback that it calls with a number from 0 to 1 as the
-    upload progresses.
+    upload progresses. If a `DedupIndex` is passed, files with the same contents
+    as a previous upload to the same account and server are skipped.
+
+    Returns a dict with the `file_id` and `s3_path` of the upload and whether
+    it was a `duplicate` of an earlier one.
+    """
+    incr('upload.files')
+    try:
+        with timer('upload.file'), profile_file(filename, 'upload'):
+            if dedup_index is None:
+                return _upload_file(filename, apikey, server_url, progress_callback,
+                                    n_callbacks)
+
+            account = account_key(server_url, apikey)
+            try:
+                with timer('upload.fingerprint'):
+                    fingerprint, previous = find_duplicate(dedup_index, account, filename)
+            except sqlite3.Error:  # e.g. the index is locked by another uploader
+                return _upload_file(filename, apikey, server_url, progress_callback,
+                                    n_callbacks)
+            if previous is not None:
+                incr('upload.duplicates')
+                if progress_callback is not None:
+                    progress_callback(filename, 1.0)
+                return previous
+
+            # hash the whole file alongside the upload to confirm future matches
+            content_hash = ContentHash(filename)
+            result = _upload_file(filename, apikey, server_url, progress_callback, n_callbacks,
+                                  content_hash)
+            try:
+                record_upload(dedup_index, account, fingerprint, content_hash, filename, result)
+            except sqlite3.Error:  # the file is uploaded either way
+                pass
+            return result
+    finally:
+        export_metrics()
+
+
+def _upload_file(filename, apikey, server_url, progress_callback=None, n_callbacks=400,
+                 content_hash=None):
+    """
+    The actual upload; see `upload_file`. A `ContentHash` of the file is
+    cancelled if the upload fails, so the error isn't held up by it.
+    """
+    try:
+        upload_params = init_upload(apikey, server_url)
+        transfer_file(filename, upload_params, progress_callback, n_callbacks)
+        return confirm_upload(filename, apikey, server_url, upload_params)
+    except:
+        if content_hash is not None:
+            content_hash.cancel()
+        raise
+
+
+def init_upload(apikey, server_url, timeout=None):
     """
-    # first check with the one codex server to get upload parameters
-    req = requests.post(server_url + 'api/v1/init_multipart_upload', auth=(apikey, ''))
+    Get the parameters (S3 bucket, credentials, file_id, etc.) for a new upload
+    from the One Codex server
+    """
+    with timer('upload.init_multipart_upload'):
+        req = requests.post(server_url + 'api/v1/init_multipart_upload', auth=(apikey, ''),
+                            timeout=timeout)
     if req.status_code == 402:
         raise UploadException('Upload limits have been exceeded. Please check your plan.')
     elif req.status_code != 200:
         raise UploadException('Could not initiate upload with One Codex server')
 
-    upload_params = req.json()
+    return req.json()
+
 
+def transfer_file(filename, upload_params, progress_callback=None, n_callbacks=400):
+    """
+    Send a file to S3 using the parameters from `init_upload`
+    """
     access_key = upload_params['upload_aws_access_key_id']
     secret_key = upload_params['upload_aws_secret_access_key']
 
@@ -127,23 +228,36 @@ def upload_file(filename, apikey, server_url, progress_callback=None, n_callback
     else:
         progress_tracker = None
 
+    config = TransferConfig()
+    if METRICS.enabled:
+        progress_tracker = PartTimer(config.multipart_chunksize, progress_tracker)
+
     # actually do the upload
     client = boto3.client('s3', aws_access_key_id=access_key, aws_secret_access_key=secret_key)
-    transfer = S3Transfer(client)
+    transfer = S3Transfer(client, config)
     try:
-        transfer.upload_file(filename, upload_params['s3_bucket'], upload_params['file_id'],
-                             extra_args={'ServerSideEncryption': 'AES256'},
-                             callback=progress_tracker)
+        with timer('upload.s3_transfer'):
+            transfer.upload_file(filename, upload_params['s3_bucket'], upload_params['file_id'],
+                                 extra_args={'ServerSideEncryption': 'AES256'},
+                                 callback=progress_tracker)
     except S3UploadFailedError:
         raise UploadException('Upload has failed. Please contact help@onecodex.com '
                               'if you experience further issues')
 
-    # return completed status to the one codex server
+
+def confirm_upload(filename, apikey, server_url, upload_params, timeout=None):
+    """
+    Tell the One Codex server that a file has finished transferring to S3
+    """
     s3_path = 's3://{}/{}'.format(upload_params['s3_bucket'], upload_params['file_id'])
     callback_url = server_url.rstrip('/') + upload_params['callback_url']
-    req = requests.post(callback_url, auth=(apikey, ''),
-                        json={'s3_path': s3_path, 'filename': os.path.basename(filename)})
+    with timer('upload.callback'):
+        req = requests.post(callback_url, auth=(apikey, ''),
+                            json={'s3_path': s3_path, 'filename': os.path.basename(filename)},
+                            timeout=timeout)
 
     if req.status_code != 200:
         raise UploadException('Upload confirmation has failed. Please contact help@onecodex.com '
                               'if you experience further issues')
+
+    return {'file_id': upload_params['file_id'], 's3_path': s3_path, 'duplicate': False}
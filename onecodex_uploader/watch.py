@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""
+Watch a folder and upload sequencing files as instruments finish writing them
+"""
+from __future__ import print_function, division
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from control import ControlPlane
+from dedup import DedupIndex, DEFAULT_INDEX_PATH
+from metrics import METRICS
+from sniff import sniff_file
+from version import __version__
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # fall back to polling the folder
+    Observer = None
+
+SEQ_EXTENSIONS = ('.fa', '.fasta', '.fna', '.fq', '.fastq')
+
+# ledgers are kept out of the watched folder, which may be read-only or an instrument's run folder
+DEFAULT_LEDGER_DIR = os.path.join(os.path.expanduser('~'), '.onecodex_uploader', 'ledgers')
+
+# files written by sequencers (Illumina RTA/MiSeq Reporter, etc.) once a run is done
+COMPLETION_MARKERS = ('RTAComplete.txt', 'CopyComplete.txt', 'RunCompletionStatus.xml')
+
+
+def is_sequence_file(filename):
+    """
+    Check if a filename looks like a (possibly gzipped) FASTA/FASTQ
+    """
+    name = os.path.basename(filename).lower()
+    if name.startswith('.'):
+        return False
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return name.endswith(SEQ_EXTENSIONS)
+
+
+def has_completion_marker(filename, markers=COMPLETION_MARKERS):
+    """
+    Check for a `<file>.done` file or a run completion marker in the same folder
+    """
+    if os.path.exists(filename + '.done'):
+        return True
+    folder = os.path.dirname(filename)
+    return any(os.path.exists(os.path.join(folder, marker)) for marker in markers)
+
+
+def default_ledger_path(folder):
+    """
+    Where the ledger for a watched folder goes unless one is given: a file
+    per folder under `DEFAULT_LEDGER_DIR`
+    """
+    folder = os.path.abspath(folder)
+    folder_hash = hashlib.sha256(folder.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(DEFAULT_LEDGER_DIR, '{}-{}.db'.format(os.path.basename(folder),
+                                                              folder_hash))
+
+
+class Ledger(object):
+    """
+    A persistent record of every file the watcher has handled, so that
+    restarting the watcher doesn't upload anything twice.
+    """
+    def __init__(self, path):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                        'status TEXT, msg TEXT, updated REAL)')
+        self.db.commit()
+
+    def seen(self, path, size, mtime):
+        """
+        True if this exact version of the file was already uploaded (or rejected)
+        """
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, status FROM files WHERE path = ?',
+                                  (path,)).fetchone()
+        return row is not None and row[2] != 'failed' and (row[0], row[1]) == (size, mtime)
+
+    def record(self, path, size, mtime, status, msg=None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                            (path, size, mtime, status, msg, time.time()))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class FolderWatcher(object):
+    """
+    Watches `folder` (recursively) for new sequencing files and uploads each
+    one once it's finished being written.
+
+    A file is considered finished once its size and mtime haven't changed for
+    `settle_time` seconds, or haven't changed between two checks and a
+    completion marker appears next to it. Files that
+    become ready together are uploaded as one batch, with at most `max_workers`
+    of them sent to S3 at once so the watcher doesn't compete with the
+    instrument for disk I/O. Files whose contents were already uploaded
+    (according to `dedup_index`) are recorded but not sent again.
+
+    Without watchdog the folder is rescanned every `poll_interval` seconds;
+    with it, it's still rescanned every `rescan_interval` seconds so that
+    failed uploads are retried.
+    """
+    def __init__(self, folder, apikey, server_url, ledger_path=None, settle_time=60,
+                 poll_interval=10, rescan_interval=600, max_workers=1, dedup_index=None,
+                 log=print):
+        self.folder = os.path.abspath(folder)
+        self.apikey = apikey
+        self.server_url = server_url
+        self.ledger = Ledger(ledger_path or default_ledger_path(self.folder))
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.dedup_index = dedup_index
+        self.max_workers = max_workers
+        self.control = ControlPlane(server_url)
+        self.executor = ThreadPoolExecutor(max_workers=1)  # batches are uploaded in order
+        self.log = log
+
+        self.lock = threading.Lock()
+        self.pending = {}  # path -> (size, mtime, time that size/mtime were first seen)
+        self.in_progress = set()
+        self.queued_bytes = 0
+        self.uploaded_bytes, self.upload_seconds = 0, 0.  # throughput for ETAs
+        self.stopped = threading.Event()
+        self.observer = None
+
+    def add(self, path):
+        if not is_sequence_file(path):
+            return
+        with self.lock:
+            if path not in self.pending and path not in self.in_progress:
+                self.pending[path] = (None, None, None)
+
+    def scan(self):
+        for root, dirs, files in os.walk(self.folder):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                self.add(os.path.join(root, name))
+
+    def check_pending(self):
+        """
+        Submit every pending file that has stopped changing for upload,
+        smallest first so a batch starts producing results as soon as possible
+        """
+        now = time.time()
+        with self.lock:
+            pending = list(self.pending.items())
+        ready = []
+        for path, (size, mtime, since) in pending:
+            try:
+                stat = os.stat(path)
+            except OSError:  # moved or deleted before we got to it
+                with self.lock:
+                    self.pending.pop(path, None)
+                continue
+
+            if self.ledger.seen(path, stat.st_size, stat.st_mtime):
+                with self.lock:
+                    self.pending.pop(path, None)
+                continue
+
+            # even with a completion marker, the file has to look the same on two
+            # checks in a row in case it's still being copied into the folder
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                with self.lock:
+                    self.pending[path] = (stat.st_size, stat.st_mtime, now)
+                continue
+            elif now - since < self.settle_time and not has_completion_marker(path):
+                continue
+
+            with self.lock:
+                self.pending.pop(path, None)
+            qc_results = self.check_file(path, stat.st_size, stat.st_mtime)
+            if qc_results is not None:
+                ready.append((qc_results['file_est_size'], path, stat.st_size, stat.st_mtime,
+                              qc_results))
+
+        if not ready:
+            return
+        ready.sort()
+        self.log('Queued {} file(s): ~{:,} reads, ~{:,} bases{}'.format(
+            len(ready), sum(r[4]['file_est_num_recs'] for r in ready),
+            sum(r[4]['file_est_num_bases'] for r in ready),
+            self.format_eta(sum(r[2] for r in ready))))
+        batch = [(path, size, mtime) for _, path, size, mtime, _ in ready]
+        with self.lock:
+            for path, size, _ in batch:
+                self.in_progress.add(path)
+                self.queued_bytes += size
+        self.executor.submit(self.process, batch)
+
+    def check_file(self, path, size, mtime):
+        """
+        Sniff a file, returning the results if it can be uploaded
+        """
+        try:
+            qc_results = sniff_file(path)
+        except Exception as e:  # e.g. a truncated gzip fails its CRC check
+            qc_results = {'file_type': 'bad', 'msg': 'Could not read file ({})'.format(e)}
+        if qc_results['file_type'] == 'bad':
+            msg = qc_results['msg']
+        elif qc_results['seq_type'] == 'aa':
+            msg = 'Amino acid FASTX files not supported'
+        else:
+            for warning in qc_results.get('qc_warnings', []):
+                self.log('Warning for {}: {}'.format(path, warning))
+            return qc_results
+        self.ledger.record(path, size, mtime, 'rejected', msg)
+        self.log('Skipping {}: {}'.format(path, msg))
+
+    def format_eta(self, new_bytes=0):
+        """
+        Estimate how long everything queued will take from the throughput of
+        previous uploads
+        """
+        with self.lock:
+            if self.upload_seconds <= 0:
+                return ''
+            remaining = self.queued_bytes + new_bytes
+            rate = self.uploaded_bytes / self.upload_seconds
+        return ' (ETA {:.0f} min)'.format(remaining / rate / 60)
+
+    def process(self, batch):
+        start = time.time()
+        results = {}
+        try:
+            self.log('Uploading {}'.format(', '.join(path for path, _, _ in batch)))
+            results = self.control.upload_files([path for path, _, _ in batch], self.apikey,
+                                                dedup_index=self.dedup_index,
+                                                max_transfers=self.max_workers)
+            uploaded_bytes = 0
+            for path, size, mtime in batch:
+                result = results[path]
+                if isinstance(result, Exception):
+                    self.ledger.record(path, size, mtime, 'failed', str(result))
+                    self.log('Failed to upload {}: {}'.format(path, result))
+                elif result['duplicate']:
+                    self.ledger.record(path, size, mtime, 'duplicate', result['s3_path'])
+                    self.log('Skipped {}: already uploaded as {}'.format(path,
+                                                                         result['s3_path']))
+                else:
+                    uploaded_bytes += size
+                    self.ledger.record(path, size, mtime, 'uploaded', result['s3_path'])
+                    self.log('Uploaded {}'.format(path))
+            if uploaded_bytes > 0:
+                with self.lock:
+                    self.uploaded_bytes += uploaded_bytes
+                    self.upload_seconds += time.time() - start
+        except Exception as e:  # don't let one bad batch go unrecorded
+            self.log('Failed to upload batch: {}'.format(e))
+            for path, size, mtime in batch:
+                if not isinstance(results.get(path), dict):
+                    self.ledger.record(path, size, mtime, 'failed', str(e))
+        finally:
+            with self.lock:
+                for path, size, _ in batch:
+                    self.in_progress.discard(path)
+                    self.queued_bytes -= size
+
+    def start_observer(self):
+        """
+        Use inotify (or the platform equivalent) to pick up new files when
+        watchdog is installed; returns False if we have to poll instead
+        """
+        if Observer is None:
+            return False
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_created(self, event):
+                if not event.is_directory:
+                    watcher.add(event.src_path)
+
+            def on_modified(self, event):  # e.g. a file rewritten in place
+                if not event.is_directory:
+                    watcher.add(event.src_path)
+
+            def on_moved(self, event):
+                if not event.is_directory:
+                    watcher.add(event.dest_path)
+
+        self.observer = Observer()
+        self.observer.schedule(Handler(), self.folder, recursive=True)
+        self.observer.start()
+        return True
+
+    def run(self):
+        """
+        Watch until `stop` is called (or the process is interrupted)
+        """
+        self.scan()  # pick up anything written while we weren't running
+        watching = self.start_observer()
+        last_scan = time.time()
+        try:
+            while not self.stopped.is_set():
+                if not watching or time.time() - last_scan >= self.rescan_interval:
+                    self.scan()
+                    last_scan = time.time()
+                self.check_pending()
+                self.stopped.wait(self.poll_interval)
+        finally:
+            if self.observer is not None:
+                self.observer.stop()
+                self.observer.join()
+            self.executor.shutdown(wait=True)
+            self.control.shutdown()
+            self.ledger.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Upload sequencing files from a folder as '
+                                                 'they are written.')
+    parser.add_argument('folder', help='Folder to watch')
+    parser.add_argument('--apikey', default=os.environ.get('ONE_CODEX_API_KEY'),
+                        help='One Codex API key (defaults to $ONE_CODEX_API_KEY)')
+    parser.add_argument('--settle-time', type=float, default=60,
+                        help='Seconds a file must be unchanged before uploading')
+    parser.add_argument('--poll-interval', type=float, default=10,
+                        help='Seconds between checks of the folder')
+    parser.add_argument('--rescan-interval', type=float, default=600,
+                        help='Seconds between full rescans of the folder (to retry failed '
+                             'uploads) when watchdog is installed')
+    parser.add_argument('--max-uploads', type=int, default=1,
+                        help='Maximum number of files to upload at once')
+    parser.add_argument('--ledger', default=None,
+                        help='Path to the ledger of uploaded files (defaults to one per '
+                             'folder in ~/.onecodex_uploader/ledgers)')
+    parser.add_argument('--dedup-index', default=DEFAULT_INDEX_PATH,
+                        help='Path to the index of previously uploaded file contents')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='Upload files even if identical ones were uploaded before')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Write upload metrics to this file in the Prometheus text format')
+
+    args = parser.parse_args()
+    if not args.apikey:
+        parser.error('An API key is required')
+    if args.metrics_file:
+        METRICS.enabled = True
+        METRICS.metrics_file = args.metrics_file
+
+    server_url = os.environ.get('ONE_CODEX_SERVER', 'https://app.onecodex.com/')
+    should_quit, error_msg = ControlPlane(server_url).check_version(__version__).result()
+    if error_msg is not None:
+        print(error_msg)
+    if should_quit:
+        raise SystemExit(1)
+
+    watcher = FolderWatcher(args.folder, args.apikey, server_url,
+                            ledger_path=args.ledger, settle_time=args.settle_time,
+                            poll_interval=args.poll_interval,
+                            rescan_interval=args.rescan_interval, max_workers=args.max_uploads,
+                            dedup_index=None if args.no_dedup else DedupIndex(args.dedup_index))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
@@ -15,7 +15,8 @@ a = Analysis(
     pathex=['C:\\Users\\Roderick\\Documents\\onecodex-uploader'],
     binaries=None,
     datas=None,
-    hiddenimports=['HTMLParser'],
+    hiddenimports=['HTMLParser', 'onecodex_uploader.watch',
+                   'watchdog.observers.read_directory_changes'],
     hookspath=[],
     runtime_hooks=[],
     excludes=[],